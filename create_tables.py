@@ -1,50 +1,44 @@
-import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from db import connect, execute_queries
+from sql_queries import create_table_queries, drop_table_queries, get_config
 
 
-def drop_tables(cur, conn):
+def drop_tables(config, conn):
     """Drop all tables by running every sql query defined in
        sql_queries.drop_table_queries
 
     Args:
-        cur: the cursor object
+        config: parsed configuration
         conn: database connection object
 
     Returns:
         None
     """
-    for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+    for queries in drop_table_queries:
+        execute_queries(config, conn, queries)
 
 
-def create_tables(cur, conn):
+def create_tables(config, conn):
     """Create all tables by running every sql query defined in
        sql_queries.create_table_queries
 
     Args:
-        cur: the cursor object
+        config: parsed configuration
         conn: database connection object
 
     Returns:
         None
     """
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+    for queries in create_table_queries:
+        execute_queries(config, conn, queries)
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    config = get_config()
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}"
-                            .format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+    conn = connect(config)
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    drop_tables(config, conn)
+    create_tables(config, conn)
 
     conn.close()
 
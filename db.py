@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+
+def connect(config):
+    """Opens a new connection to the database defined in the CLUSTER section
+
+    Args:
+        config: parsed configuration
+
+    Returns:
+        database connection object
+    """
+    return psycopg2.connect("host={} dbname={} user={} password={} port={}"
+                            .format(*config['CLUSTER'].values()))
+
+
+def execute_query(conn, query):
+    """Runs a sql query on the given database connection and commits it
+
+    Args:
+        conn: database connection object
+        query (str): sql query
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        cur.execute(query)
+    conn.commit()
+
+
+def execute_query_on_new_connection(config, query):
+    """Runs a sql query on its own database connection
+
+    Args:
+        config: parsed configuration
+        query (str): sql query
+
+    Returns:
+        None
+    """
+    conn = connect(config)
+    try:
+        execute_query(conn, query)
+    finally:
+        conn.close()
+
+
+def execute_queries(config, conn, queries):
+    """Runs a group of independent sql queries. A single query is run on the
+       given connection, several queries run concurrently, every query on
+       its own database connection
+
+    Args:
+        config: parsed configuration
+        conn: database connection object
+        queries (tuple): sql queries
+
+    Returns:
+        None
+    """
+    if len(queries) == 1:
+        execute_query(conn, queries[0])
+        return
+
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [executor.submit(execute_query_on_new_connection,
+                                   config, query)
+                   for query in queries]
+        for future in futures:
+            future.result()
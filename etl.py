@@ -1,51 +1,43 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from db import connect, execute_queries, execute_query
+from sql_queries import get_config, get_copy_queries, insert_table_queries
 
 
-def load_staging_tables(cur, conn):
-    """Loads data form S3 into staging tables by running every sql query defined in
-       sql_queries.copy_table_queries
+def load_staging_tables(config, conn):
+    """Loads data form S3 into staging tables by running every sql query
+       returned by sql_queries.get_copy_queries concurrently
 
     Args:
-        cur: the cursor object
+        config: parsed configuration
         conn: database connection object
 
     Returns:
         None
     """
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+    execute_queries(config, conn, get_copy_queries())
 
 
-def insert_tables(cur, conn):
+def insert_tables(config, conn):
     """Inserts data from staging tables into fact and dimension tables by
        running every sql query defined in sql_queries.insert_table_queries
 
     Args:
-        cur: the cursor object
+        config: parsed configuration
         conn: database connection object
 
     Returns:
         None
     """
     for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+        execute_query(conn, query)
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    config = get_config()
 
-    conn = psycopg2.connect(
-        "host={} dbname={} user={} password={} port={}"
-        .format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+    conn = connect(config)
 
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    load_staging_tables(config, conn)
+    insert_tables(config, conn)
 
     conn.close()
 
@@ -1,108 +1,112 @@
-import configparser
-import json
-import time
+import os
+from functools import lru_cache
 
 import boto3
-from click import Option, UsageError, command, option
+from botocore.config import Config
+from botocore.exceptions import ClientError, WaiterError
+from click import ClickException, group
+from sql_queries import get_config
 
+# CloudFormation template describing the IAM role and the redshift cluster
+STACK_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'redshift_stack.yaml')
 
-class MutuallyExclusiveOption(Option):
-    """
-    Implements mutually exclusive options for click module
-    """
 
-    def __init__(self, *args, **kwargs):
-        self.mutually_exclusive = set(kwargs.pop('mutually_exclusive', []))
-        help = kwargs.get('help', '')
-        if self.mutually_exclusive:
-            ex_str = ', '.join(self.mutually_exclusive)
-            kwargs['help'] = help + (
-                ' NOTE: This argument is mutually exclusive with '
-                ' arguments: [' + ex_str + '].'
-            )
-        super(MutuallyExclusiveOption, self).__init__(*args, **kwargs)
-
-    def handle_parse_result(self, ctx, opts, args):
-        if self.mutually_exclusive.intersection(opts) and self.name in opts:
-            raise UsageError(
-                "Illegal usage: `{}` is mutually exclusive with "
-                "arguments `{}`.".format(
-                    self.name,
-                    ', '.join(self.mutually_exclusive)
-                )
-            )
-
-        return super(MutuallyExclusiveOption, self).handle_parse_result(
-            ctx,
-            opts,
-            args
-        )
-
-
-def create_iam_role(iam_client, DWH_IAM_ROLE_NAME):
-    """Creates an IAM role allowing redshift cluster access AWS services
+def get_stack(cf_client, stack_name):
+    """Retrieves the CloudFormation stack
 
     Args:
-        iam_client (IAM.Client): client to access IAM service
-        DWH_IAM_ROLE_NAME (str): IAM role name
+        cf_client (CloudFormation.Client): client to access CloudFormation
+        stack_name (str): stack name
 
     Returns:
-        dict: information about the specified role
+        dict: description of the stack or None if it does not exist
     """
     try:
-        print("Creating a new IAM Role: {}".format(DWH_IAM_ROLE_NAME))
-        dwhRole = iam_client.create_role(
-            Path='/',
-            RoleName=DWH_IAM_ROLE_NAME,
-            Description="Allows Redshift clusters to \
-                call AWS services on your behalf.",
-            AssumeRolePolicyDocument=json.dumps(
-                {'Statement': [{'Action': 'sts:AssumeRole',
-                                'Effect': 'Allow',
-                                'Principal':
-                                    {'Service':
-                                        'redshift.amazonaws.com'}}],
-                    'Version': '2012-10-17'})
-        )
-        print("Attaching Policy")
-        iam_client.attach_role_policy(
-            RoleName=DWH_IAM_ROLE_NAME,
-            PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-        )['ResponseMetadata']['HTTPStatusCode']
-        return dwhRole['Role']
-    except Exception as e:
-        print(e)
-
-
-def delete_iam_role(iam_client, DWH_IAM_ROLE_NAME):
-    """Deletes an IAM role
+        return cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except ClientError as e:
+        # a missing stack is reported as a generic ValidationError
+        if 'does not exist' in e.response['Error'].get('Message', ''):
+            return None
+        raise
 
-    Args:
-        iam_client (IAM.Client): client to access IAM service
-        DWH_IAM_ROLE_NAME (str): IAM role name
-    """
-    try:
-        print("Deleting the IAM Role: {}".format(DWH_IAM_ROLE_NAME))
-        iam_client.delete_role(DWH_IAM_ROLE_NAME)
-    except Exception as e:
-        print(e)
 
-
-def get_iam_role(iam_client, DWH_IAM_ROLE_NAME):
-    """Gets an IAM role
+def deploy_stack(cf_client, stack_name, parameters):
+    """Creates the CloudFormation stack with the IAM role and the redshift
+       cluster or updates it if it already exists and waits until it is
+       completed
 
     Args:
-        iam_client (IAM.Client): client to access IAM service
-        DWH_IAM_ROLE_NAME (str): IAM role name
+        cf_client (CloudFormation.Client): client to access CloudFormation
+        stack_name (str): stack name
+        parameters (dict): template parameters
 
     Returns:
-        dict: information about the specified role
+        dict: stack outputs
     """
-    try:
-        print("Get the IAM Role: {}".format(DWH_IAM_ROLE_NAME))
-        return iam_client.get_role(RoleName=DWH_IAM_ROLE_NAME)['Role']
-    except Exception as e:
-        print(e)
+    with open(STACK_TEMPLATE) as f:
+        template_body = f.read()
+
+    stack_args = {
+        'StackName': stack_name,
+        'TemplateBody': template_body,
+        'Parameters': [{'ParameterKey': key, 'ParameterValue': value}
+                       for key, value in parameters.items()],
+        'Capabilities': ['CAPABILITY_NAMED_IAM'],
+    }
+
+    stack = get_stack(cf_client, stack_name)
+
+    if(stack and stack['StackStatus'] == 'ROLLBACK_COMPLETE'):
+        raise ClickException(
+            "CloudFormation stack {} failed to create and can not be "
+            "updated, run `python redshift_util.py delete` first"
+            .format(stack_name))
+
+    if(not stack):
+        print("Create CloudFormation stack: {}".format(stack_name))
+        # a failed create removes the stack again so create can be rerun
+        cf_client.create_stack(**stack_args, OnFailure='DELETE')
+
+        print("Waiting for CloudFormation stack to be created")
+        cf_client.get_waiter('stack_create_complete').wait(
+            StackName=stack_name,
+            WaiterConfig={'Delay': 30, 'MaxAttempts': 40})
+    else:
+        print("Update CloudFormation stack: {}".format(stack_name))
+        try:
+            cf_client.update_stack(**stack_args)
+        except ClientError as e:
+            if 'No updates are to be performed' not in \
+                    e.response['Error'].get('Message', ''):
+                raise
+            print("CloudFormation stack is up to date: {}"
+                  .format(stack_name))
+        else:
+            print("Waiting for CloudFormation stack to be updated")
+            cf_client.get_waiter('stack_update_complete').wait(
+                StackName=stack_name,
+                WaiterConfig={'Delay': 30, 'MaxAttempts': 40})
+
+    stack = get_stack(cf_client, stack_name)
+    return {output['OutputKey']: output['OutputValue']
+            for output in stack.get('Outputs', [])}
+
+
+def delete_stack(cf_client, stack_name):
+    """Deletes the CloudFormation stack and waits until it is deleted
+
+    Args:
+        cf_client (CloudFormation.Client): client to access CloudFormation
+        stack_name (str): stack name
+    """
+    print("Delete CloudFormation stack: {}".format(stack_name))
+    cf_client.delete_stack(StackName=stack_name)
+
+    print("Waiting for CloudFormation stack to be deleted")
+    cf_client.get_waiter('stack_delete_complete').wait(
+        StackName=stack_name,
+        WaiterConfig={'Delay': 30, 'MaxAttempts': 40})
 
 
 def get_cluster_status(redshift_client, DWH_CLUSTER_IDENTIFIER):
@@ -124,163 +128,109 @@ def get_cluster_status(redshift_client, DWH_CLUSTER_IDENTIFIER):
         return 'unknown'
 
 
-def create_redshift_cluster(redshift_client, roleArn, DWH_CLUSTER_TYPE,
-                            DWH_NODE_TYPE, DWH_NUM_NODES, DWH_DB,
-                            DWH_CLUSTER_IDENTIFIER, DWH_DB_USER,
-                            DWH_DB_PASSWORD):
-    """Creates Redshift cluster
-
-    Args:
-        redshift_client (Redshift.Client): client to access Redshift service
-        roleArn (str): ARN of the IAM role
-        DWH_CLUSTER_TYPE (str): cluster type (single-node, multi-node)
-        DWH_NODE_TYPE (str): EC2 type of the nodes (dc2.large)
-        DWH_NUM_NODES (str): number of nodes (only for multi-node cluster)
-        DWH_DB (str): data base name
-        DWH_CLUSTER_IDENTIFIER (str): cluster name
-        DWH_DB_USER (str): db user name
-        DWH_DB_PASSWORD (str): db user password
+@lru_cache(maxsize=1)
+def _get_clients():
+    """Creates the CloudFormation and Redshift clients using the credentials
+       and region defined in dwh.cfg
 
     Returns:
-        dict: response of the create cluster call
+        tuple: CloudFormation.Client and Redshift.Client
     """
-    try:
-        print("Create Redshift cluster: {}"
-              .format(DWH_CLUSTER_IDENTIFIER))
-        # HW
-        hw_params = {'ClusterType': DWH_CLUSTER_TYPE}
-        if (DWH_NODE_TYPE == "multi-node"):
-            hw_params['NumberOfNodes'] = int(DWH_NUM_NODES)
-        hw_params['NodeType'] = DWH_NODE_TYPE
-
-        response = redshift_client.create_cluster(
-            **hw_params,
-
-            # Identifiers & Credentials
-            DBName=DWH_DB,
-            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
-            MasterUsername=DWH_DB_USER,
-            MasterUserPassword=DWH_DB_PASSWORD,
-
-            # Roles (for s3 access)
-            IamRoles=[roleArn]
-        )
-        return response
-    except Exception as e:
-        print(e)
-
-
-def delete_redshift_cluster(redshift_client, DWH_CLUSTER_IDENTIFIER):
-    """Deletes redshift cluster
-
-    Args:
-        redshift_client (Redshift.Client): client to access Redshift service
-        DWH_CLUSTER_IDENTIFIER (str): cluster name
-    """
-    try:
-        print("Delete Redshift cluster: {}"
-              .format(DWH_CLUSTER_IDENTIFIER))
-        redshift_client.delete_cluster(
-            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
-            SkipFinalClusterSnapshot=True)
-    except Exception as e:
-        print(e)
-
-
-@command()
-@option('--create', '-c', cls=MutuallyExclusiveOption,
-        help=u'Create redshift cluster.',
-        mutually_exclusive=["delete", "status"],
-        is_flag=True)
-@option('--delete', '-d', cls=MutuallyExclusiveOption,
-        help=u'Delete redshift cluster.',
-        mutually_exclusive=["create", "status"],
-        is_flag=True)
-@option('--status', '-s', cls=MutuallyExclusiveOption,
-        help=u'Get status of redshift cluster.',
-        mutually_exclusive=["create", "delete"],
-        is_flag=True)
-def main(create, delete, status):
-
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    config = get_config()
 
     KEY = config.get('AWS', 'KEY')
     SECRET = config.get('AWS', 'SECRET')
 
-    DWH_CLUSTER_TYPE = config.get("DWH", "DWH_CLUSTER_TYPE")
-    DWH_NUM_NODES = config.get("DWH", "DWH_NUM_NODES")
-    DWH_NODE_TYPE = config.get("DWH", "DWH_NODE_TYPE")
+    DWH_REGION = config.get("DWH", "DWH_REGION")
 
-    DWH_CLUSTER_IDENTIFIER = config.get("DWH", "DWH_CLUSTER_IDENTIFIER")
-    DWH_DB = config.get("DWH", "DWH_DB")
-    DWH_DB_USER = config.get("DWH", "DWH_DB_USER")
-    DWH_DB_PASSWORD = config.get("DWH", "DWH_DB_PASSWORD")
+    # keep connections alive between calls to avoid repeated TLS handshakes
+    bcfg = Config(tcp_keepalive=True, connect_timeout=5, read_timeout=30,
+                  retries={'mode': 'standard', 'max_attempts': 5})
 
-    DWH_IAM_ROLE_NAME = config.get("DWH", "DWH_IAM_ROLE_NAME")
+    # one session resolves the credentials once for both clients
+    session = boto3.Session(aws_access_key_id=KEY,
+                            aws_secret_access_key=SECRET,
+                            region_name=DWH_REGION)
+
+    cf_client = session.client('cloudformation', config=bcfg)
+    redshift_client = session.client('redshift', config=bcfg)
+
+    return cf_client, redshift_client
 
-    DWH_REGION = config.get("DWH", "DWH_REGION")
 
-    iam_client = boto3.client('iam', aws_access_key_id=KEY,
-                              aws_secret_access_key=SECRET,
-                              region_name=DWH_REGION
-                              )
+@group()
+def main():
+    """Manages the redshift cluster defined in dwh.cfg"""
 
-    redshift_client = boto3.client('redshift',
-                                   region_name=DWH_REGION,
-                                   aws_access_key_id=KEY,
-                                   aws_secret_access_key=SECRET
-                                   )
 
-    if(status):
+@main.command()
+def status():
+    """Get status of redshift cluster."""
 
+    DWH_CLUSTER_IDENTIFIER = get_config().get("DWH", "DWH_CLUSTER_IDENTIFIER")
+
+    _, redshift_client = _get_clients()
+
+    try:
         print(get_cluster_status(redshift_client, DWH_CLUSTER_IDENTIFIER))
+    except ClientError as e:
+        raise ClickException(str(e))
+
 
-    if(create):
+@main.command()
+def create():
+    """Create redshift cluster."""
 
-        dwhRole = get_iam_role(iam_client, DWH_IAM_ROLE_NAME)
+    config = get_config()
 
-        if(not dwhRole):
-            dwhRole = create_iam_role(iam_client, DWH_IAM_ROLE_NAME)
+    DWH_STACK_NAME = config.get("DWH", "DWH_STACK_NAME", fallback="dwh")
 
-        status = get_cluster_status(redshift_client, DWH_CLUSTER_IDENTIFIER)
+    parameters = {
+        'DWHIamRoleName': config.get("DWH", "DWH_IAM_ROLE_NAME"),
+        'DWHClusterIdentifier': config.get("DWH", "DWH_CLUSTER_IDENTIFIER"),
+        'DWHClusterType': config.get("DWH", "DWH_CLUSTER_TYPE"),
+        'NodeType': config.get("DWH", "DWH_NODE_TYPE"),
+        'DBName': config.get("DWH", "DWH_DB"),
+        'MasterUsername': config.get("DWH", "DWH_DB_USER"),
+        'MasterUserPassword': config.get("DWH", "DWH_DB_PASSWORD"),
+    }
+    # number of nodes is only used by multi-node clusters, single-node
+    # clusters use the template default
+    if(parameters['DWHClusterType'] == "multi-node"):
+        parameters['NumberOfNodes'] = config.get("DWH", "DWH_NUM_NODES")
 
-        if(status == 'unknown'):
-            create_redshift_cluster(redshift_client, dwhRole['Arn'],
-                                    DWH_CLUSTER_TYPE, DWH_NODE_TYPE,
-                                    DWH_NUM_NODES, DWH_DB,
-                                    DWH_CLUSTER_IDENTIFIER,
-                                    DWH_DB_USER, DWH_DB_PASSWORD)
-            time.sleep(10)
+    cf_client, _ = _get_clients()
 
-            i = 10
-            while i > 0:
-                status = get_cluster_status(
-                    redshift_client, DWH_CLUSTER_IDENTIFIER)
-                if(status == 'available'):
-                    break
-                i -= 1
-                time.sleep(10)
+    try:
+        outputs = deploy_stack(cf_client, DWH_STACK_NAME, parameters)
+    except (ClientError, WaiterError) as e:
+        raise ClickException("Creating CloudFormation stack {} failed: {}"
+                             .format(DWH_STACK_NAME, e))
+
+    for key, value in outputs.items():
+        print("{}: {}".format(key, value))
 
-                print(status)
 
-    if(delete):
+@main.command()
+def delete():
+    """Delete redshift cluster."""
 
-        status = get_cluster_status(redshift_client, DWH_CLUSTER_IDENTIFIER)
+    config = get_config()
 
-        if(status == 'available'):
-            delete_redshift_cluster(redshift_client, DWH_CLUSTER_IDENTIFIER)
+    DWH_STACK_NAME = config.get("DWH", "DWH_STACK_NAME", fallback="dwh")
+    DWH_CLUSTER_IDENTIFIER = config.get("DWH", "DWH_CLUSTER_IDENTIFIER")
 
-            i = 10
-            while i > 0:
-                status = get_cluster_status(
-                    redshift_client, DWH_CLUSTER_IDENTIFIER)
-                if(status == 'unknown'):
-                    break
-                i -= 1
-                time.sleep(10)
+    cf_client, _ = _get_clients()
 
-                print(status)
+    try:
+        if(not get_stack(cf_client, DWH_STACK_NAME)):
+            raise ClickException(
+                "no CloudFormation stack {}; cluster {} is not managed by "
+                "this stack".format(DWH_STACK_NAME, DWH_CLUSTER_IDENTIFIER))
+        delete_stack(cf_client, DWH_STACK_NAME)
+    except (ClientError, WaiterError) as e:
+        raise ClickException("Deleting CloudFormation stack {} failed: {}"
+                             .format(DWH_STACK_NAME, e))
 
 
 if __name__ == "__main__":
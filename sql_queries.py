@@ -1,61 +1,74 @@
 import configparser
+import sys
+from functools import lru_cache
 
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+@lru_cache(maxsize=1)
+def get_config():
+    """Reads and parses dwh.cfg once, subsequent calls return the same object
+
+    Returns:
+        configparser.ConfigParser: parsed configuration
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    return config
+
 
 # DROP TABLES
 
-staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
-staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
-songplay_table_drop = "DROP TABLE IF EXISTS songplays"
-user_table_drop = "DROP TABLE IF EXISTS users"
-song_table_drop = "DROP TABLE IF EXISTS songs"
-artist_table_drop = "DROP TABLE IF EXISTS artists"
-time_table_drop = "DROP TABLE IF EXISTS time"
+staging_events_table_drop = sys.intern("DROP TABLE IF EXISTS staging_events")
+staging_songs_table_drop = sys.intern("DROP TABLE IF EXISTS staging_songs")
+songplay_table_drop = sys.intern("DROP TABLE IF EXISTS songplays")
+user_table_drop = sys.intern("DROP TABLE IF EXISTS users")
+song_table_drop = sys.intern("DROP TABLE IF EXISTS songs")
+artist_table_drop = sys.intern("DROP TABLE IF EXISTS artists")
+time_table_drop = sys.intern("DROP TABLE IF EXISTS time")
 
 # CREATE TABLES
 
-staging_events_table_create = ("""
+staging_events_table_create = sys.intern("""
 CREATE TABLE IF NOT EXISTS staging_events(
-    artist varchar,
-    auth varchar,
-    firstName varchar,
-    gender varchar,
-    itemInSession int,
-    lastName varchar,
-    length float,
-    level varchar,
-    location varchar,
-    method varchar,
-    page varchar,
-    registration float,
-    sessionId int,
-    song varchar,
-    status int,
-    ts bigint,
-    userAgent varchar,
-    userId int
+    artist varchar ENCODE zstd,
+    auth varchar ENCODE zstd,
+    firstName varchar ENCODE zstd,
+    gender varchar ENCODE zstd,
+    itemInSession int ENCODE az64,
+    lastName varchar ENCODE zstd,
+    length float ENCODE zstd,
+    level varchar ENCODE zstd,
+    location varchar ENCODE zstd,
+    method varchar ENCODE zstd,
+    page varchar ENCODE zstd,
+    registration float ENCODE zstd,
+    sessionId int ENCODE az64,
+    song varchar ENCODE zstd,
+    status int ENCODE az64,
+    ts bigint ENCODE raw,
+    userAgent varchar ENCODE zstd,
+    userId int ENCODE az64
 )
+DISTKEY(song) SORTKEY(ts)
 """)
 
-staging_songs_table_create = ("""
+staging_songs_table_create = sys.intern("""
 CREATE TABLE IF NOT EXISTS staging_songs(
-    num_songs int,
-    artist_id varchar,
-    artist_latitude float,
-    artist_longitude float,
-    artist_location varchar,
-    artist_name varchar,
-    song_id varchar,
-    title varchar,
-    duration float,
-    year int
+    num_songs int ENCODE az64,
+    artist_id varchar ENCODE zstd,
+    artist_latitude float ENCODE zstd,
+    artist_longitude float ENCODE zstd,
+    artist_location varchar ENCODE zstd,
+    artist_name varchar ENCODE zstd,
+    song_id varchar ENCODE raw,
+    title varchar ENCODE zstd,
+    duration float ENCODE zstd,
+    year int ENCODE az64
 )
+DISTKEY(title) SORTKEY(song_id)
 """)
 
-songplay_table_create = ("""
+songplay_table_create = sys.intern("""
 CREATE TABLE IF NOT EXISTS songplays(
     songplay_id bigint IDENTITY(0,1) PRIMARY KEY,
     start_time timestamp NOT NULL,
@@ -71,9 +84,10 @@ CREATE TABLE IF NOT EXISTS songplays(
     FOREIGN KEY (user_id) REFERENCES users (user_id),
     FOREIGN KEY (song_id) REFERENCES songs (song_id)
 )
+DISTKEY(song_id) SORTKEY(start_time)
 """)
 
-user_table_create = ("""
+user_table_create = sys.intern("""
 CREATE TABLE IF NOT EXISTS users (
     user_id int PRIMARY KEY,
     first_name varchar NOT NULL,
@@ -81,9 +95,10 @@ CREATE TABLE IF NOT EXISTS users (
     gender varchar(1) NOT NULL,
     level varchar NOT NULL
 )
+DISTSTYLE ALL SORTKEY(user_id)
 """)
 
-song_table_create = ("""
+song_table_create = sys.intern("""
 CREATE TABLE IF NOT EXISTS songs (
     song_id varchar PRIMARY KEY,
     title varchar NOT NULL,
@@ -92,9 +107,10 @@ CREATE TABLE IF NOT EXISTS songs (
     duration numeric,
     FOREIGN KEY (artist_id) REFERENCES artists (artist_id)
 )
+DISTKEY(song_id) SORTKEY(song_id)
 """)
 
-artist_table_create = ("""
+artist_table_create = sys.intern("""
 CREATE TABLE IF NOT EXISTS artists (
     artist_id varchar PRIMARY KEY,
     name varchar NOT NULL,
@@ -102,9 +118,10 @@ CREATE TABLE IF NOT EXISTS artists (
     latitude float,
     longitude float
 )
+DISTSTYLE ALL SORTKEY(artist_id)
 """)
 
-time_table_create = ("""
+time_table_create = sys.intern("""
 CREATE TABLE IF NOT EXISTS time (
     start_time timestamp PRIMARY KEY,
     hour int,
@@ -114,111 +131,158 @@ CREATE TABLE IF NOT EXISTS time (
     year int,
     weekday int
 )
+DISTSTYLE ALL SORTKEY(start_time)
 """)
 
+
 # STAGING TABLES
+@lru_cache(maxsize=1)
+def get_copy_queries():
+    """Builds the queries loading the staging tables from S3
+
+    Returns:
+        tuple: copy queries for staging_events and staging_songs
+    """
+    config = get_config()
 
-staging_events_copy = ("""
+    staging_events_copy = ("""
     copy staging_events
     from {}
     iam_role {}
     format as json {}
+    compupdate off statupdate off
+    truncatecolumns blanksasnull emptyasnull
+    maxerror 100
 """).format(
-    config['S3']['LOG_DATA'],
-    config['IAM_ROLE']['ARN'],
-    config['S3']['LOG_JSONPATH'])
+        config['S3']['LOG_DATA'],
+        config['IAM_ROLE']['ARN'],
+        config['S3']['LOG_JSONPATH'])
 
-staging_songs_copy = ("""
+    staging_songs_copy = ("""
     copy staging_songs
     from {}
     iam_role {}
     json 'auto'
+    compupdate off statupdate off
+    truncatecolumns blanksasnull emptyasnull
+    maxerror 100
 """).format(config['S3']['SONG_DATA'], config['IAM_ROLE']['ARN'])
 
+    return staging_events_copy, staging_songs_copy
+
+
 # FINAL TABLES
 
-songplay_table_insert = ("""
+songplay_table_insert = sys.intern("""
 INSERT INTO songplays (
     start_time, user_id, level, song_id,
     artist_id, session_id, location, user_agent)
+WITH e AS (
+    SELECT ts, userId, level, sessionId, location, userAgent,
+        song, artist, length,
+        STRTOL(SUBSTRING(MD5(
+            song || '|' || artist || '|' || CAST(length AS varchar)
+        ), 1, 15), 16) AS join_key
+    FROM staging_events
+    WHERE page='NextSong'
+), s AS (
+    SELECT song_id, artist_id, title, artist_name, duration,
+        STRTOL(SUBSTRING(MD5(
+            title || '|' || artist_name || '|' || CAST(duration AS varchar)
+        ), 1, 15), 16) AS join_key
+    FROM staging_songs
+)
 SELECT
-    DATEADD(ms, ts, '1970-01-01 00:00:00') AS start_time,
-    events.userId as user_id,
-    events.level,
-    songs.song_id,
-    songs.artist_id,
-    events.sessionId AS session_id,
-    events.location,
-    events.userAgent AS user_agent
-FROM staging_events events
-JOIN staging_songs songs
-ON (events.song = songs.title
-AND events.length = songs.duration
-AND events.artist = songs.artist_name)
-WHERE events.page='NextSong';
+    DATEADD(ms, e.ts, '1970-01-01 00:00:00') AS start_time,
+    e.userId as user_id,
+    e.level,
+    s.song_id,
+    s.artist_id,
+    e.sessionId AS session_id,
+    e.location,
+    e.userAgent AS user_agent
+FROM e
+JOIN s
+ON (e.join_key = s.join_key
+AND e.song = s.title
+AND e.length = s.duration
+AND e.artist = s.artist_name);
 """)
 
-user_table_insert = ("""
+user_table_insert = sys.intern("""
 INSERT INTO users (user_id, first_name, last_name, gender, level)
-SELECT
-    DISTINCT
-    userId as user_id,
-    firstName as first_name,
-    lastName as last_name,
-    gender,
-    last_value(level) over (
-            partition by userId
-            rows between unbounded preceding and unbounded following)
-FROM staging_events WHERE userId is NOT NULL;
+SELECT DISTINCT user_id, first_name, last_name, gender, level
+FROM (
+    SELECT
+        userId as user_id,
+        firstName as first_name,
+        lastName as last_name,
+        gender,
+        last_value(level) over (
+                partition by userId order by ts
+                rows between unbounded preceding and unbounded following)
+            AS level
+    FROM staging_events WHERE userId is NOT NULL
+) AS u;
 """)
 
-song_table_insert = ("""
+song_table_insert = sys.intern("""
 INSERT INTO songs (song_id, title, artist_id, year, duration)
 SELECT
-    DISTINCT song_id,
-    title,
-    artist_id,
-    year,
-    duration
-FROM staging_songs;
+    song_id,
+    MAX(title),
+    MAX(artist_id),
+    MAX(year),
+    MAX(duration)
+FROM staging_songs
+GROUP BY song_id;
 """)
 
-artist_table_insert = ("""
+artist_table_insert = sys.intern("""
 INSERT INTO artists (artist_id, name, location, latitude, longitude)
 SELECT
-    DISTINCT artist_id,
-    artist_name,
-    artist_location,
-    artist_latitude,
-    artist_longitude
-FROM staging_songs;
+    artist_id,
+    MAX(artist_name),
+    MAX(artist_location),
+    MAX(artist_latitude),
+    MAX(artist_longitude)
+FROM staging_songs
+GROUP BY artist_id;
 """)
 
-time_table_insert = ("""
+time_table_insert = sys.intern("""
 INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-SELECT DISTINCT(DATEADD(ms, ts, '1970-01-01 00:00:00')) as start_time,
+WITH t AS (
+    SELECT DISTINCT DATEADD(ms, ts, '1970-01-01 00:00:00') AS start_time
+    FROM staging_events
+)
+SELECT start_time,
         EXTRACT (hour FROM start_time) AS hour,
         EXTRACT (day FROM start_time) AS day,
         EXTRACT (week FROM start_time) AS week,
         EXTRACT (month FROM start_time) AS month,
         EXTRACT (year FROM start_time) AS year,
         EXTRACT (weekday FROM start_time) AS weekday
-FROM staging_events;
+FROM t;
 """)
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create,
-                        staging_songs_table_create, user_table_create,
-                        artist_table_create, song_table_create,
-                        time_table_create, songplay_table_create]
+# Queries are grouped by their foreign key dependencies. The queries within
+# a group are independent and may run concurrently, the groups have to be
+# run one after another.
 
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop,
-                      songplay_table_drop, user_table_drop, song_table_drop,
-                      artist_table_drop, time_table_drop]
+create_table_queries = ((staging_events_table_create,
+                         staging_songs_table_create, user_table_create,
+                         artist_table_create, time_table_create),
+                        (song_table_create,),
+                        (songplay_table_create,))
 
-copy_table_queries = [staging_events_copy, staging_songs_copy]
+drop_table_queries = ((songplay_table_drop,),
+                      (song_table_drop,),
+                      (staging_events_table_drop, staging_songs_table_drop,
+                       user_table_drop, artist_table_drop, time_table_drop))
 
-insert_table_queries = [user_table_insert, artist_table_insert,
+insert_table_queries = (user_table_insert, artist_table_insert,
                         song_table_insert, time_table_insert,
-                        songplay_table_insert]
+                        songplay_table_insert)